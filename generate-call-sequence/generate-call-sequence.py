@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Given an call sequence specification file (gcs) and an input file (or stdin)
 # in CSV format, generate the call sequence using Chrome's trace event viewer
@@ -32,9 +32,9 @@
 # - For instructions on usage and use cases, please see README.md in this
 #   directory.
 
-from __future__ import print_function
 import sys
 import re
+import array
 import string
 import collections
 
@@ -54,10 +54,18 @@ validSpecRE = re.compile(r"^(%s):((%s),(%s),(%s)|(%s),(%s)|(%s))$" % (
   codeSpecifierRES, codeSpecifierRES,
   codeSpecifierRES) )
 
+# translation table that deletes all whitespace (used to normalize spec lines)
+whitespaceTrans = str.maketrans('', '', string.whitespace)
+
+# long names of the check spaces used in semantic validation error messages
+checkSpaceNames = { 'l': 'label',
+                    's': 'code',
+                    'c': 'context' }
+
 # helper to convert given code specifier into an integer (None passes through)
 def codeSpecifierAsInt(s):
   # we could reuse the REs from above, but that would be overkill
-  if s == None:
+  if s is None:
     return None
   if s.startswith('0x'):
     return int(s, 16)
@@ -80,12 +88,12 @@ def parseSpec(input):
     # just the the bit before any comment
     content = line.split('#', 1)[0]
     # remove all whitespace from the line
-    content = "".join(content.split())
+    content = content.translate(whitespaceTrans)
     if len(content) > 0:
 
       # print("'%s'" % (content,))
       matcho = validSpecRE.match(content)
-      if matcho == None:
+      if matcho is None:
         print("ERROR(%s:%u): '%s' is not valid spec entry" % (
           input.name, lineNumber, content), file=sys.stderr)
         haveErrors = True
@@ -95,11 +103,11 @@ def parseSpec(input):
         # prepare the event (we still need to convert the code specifiers into
         # integers)
         ev = None
-        if groups[-1] != None:
+        if groups[-1] is not None:
           # single event matcher, easiest
           #   ('single', 'D', None, None, None, None, None, 'D')
           ev = [label, groups[-1], None, None]
-        elif groups[-2] != None:
+        elif groups[-2] is not None:
           # entry and exit defined, but no new context
           #   ('powerdown', 'G,g', None, None, None, 'G', 'g', None)
           ev = [label, groups[-3], groups[-2], None]
@@ -132,31 +140,24 @@ def parseSpec(input):
 # Returns True/False based on validity, will emit to stderr if semantic issues
 # are found.
 def isSpecSemanticallyValid(spec):
-  # will contain space:k -> num-of-duplicates (0 = no duplicates). Will not
-  # include counters for values that are none
-  checkSpace = collections.Counter()
-
-  # we will run checkMap 4 times for each spec entry, in the order of l,s,s,c
+  # we will check 4 spaces for each spec entry, in the order of l,s,s,c
   # any entry in spec that is None is skipped over (to simplify logic later)
   entrySpaceNames = "lssc"
-  for specEntry in spec:
-    for x in range(4):
-      v = specEntry[x]
-      if v != None:
-        k = "%s:%s" % (entrySpaceNames[x], v)
-        checkSpace[k] += 1
-
-  # pick entries whose value is above 1 indicating a duplicate. we use items()
-  # here instead of iteritems to support py2/py3 (not perf-critical)
+  # will contain space:k -> num-of-occurrences. Will not include counters for
+  # values that are none. counted in a single update from a generator
+  checkSpace = collections.Counter(
+    "%s:%s" % (entrySpaceNames[x], specEntry[x])
+    for specEntry in spec
+    for x in range(4)
+    if specEntry[x] is not None)
+
+  # pick entries whose value is above 1 indicating a duplicate
   dups = [(k,v) for k,v in checkSpace.items() if v > 1]
   # print("Duplicates: %s" % str(dups) )
   if len(dups) > 0:
-    longNames = { 'l': 'label',
-                  's': 'code',
-                  'c': 'context' }
     for k,v in sorted(dups):
       print("ERROR(semantic): %s '%s' defined %u times" % (
-        longNames[k[0]], k[2:], v), file=sys.stderr )
+        checkSpaceNames[k[0]], k[2:], v), file=sys.stderr )
 
     return False
 
@@ -176,35 +177,64 @@ class NestedBuilder:
 
   actionNames = [ "ENTER", "RETURN", "MARK" ]
 
+  __slots__ = ('codeTable', 'codeMap', 'actions', 'stack', 'emitTS',
+               'emitLabel', 'emitDuration', 'emitKind', 'currentContext')
+
+  # Kinds of emitted events. Values are in the order in which the events sort
+  # when they share the same timestamp:
+  # - context-end is before context-start (ie, context switch)
+  # - context-start is before anything else
+  KIND_CONTEXT_END = 0
+  KIND_CONTEXT_START = 1
+  KIND_PLAIN = 2
+
+  # codes below this are looked up from a flat table instead of codeMap
+  CODE_TABLE_SIZE = 256
+
   # create new builder using the spec
   def __init__(self, spec):
-    # this map will contain code -> (action, label, context) based on spec
+    # these will contain code -> (action, label, context) based on spec. byte
+    # sized codes (the common case) are indexed directly from codeTable, the
+    # rest go into codeMap
+    self.codeTable = [None] * self.CODE_TABLE_SIZE
     self.codeMap = {}
     # once we get data from CSV, we'll collect the actions here
     self.actions = []
     # once we're resolving, this will hold the current stack of
     # [startTS, label, context] entries
     self.stack = []
-    # emitted events will be collected here
-    # [startTS, label, duration|None] (None for marks)
-    # [startTS, "sctx:label", None] for start context marker
-    # [startTS, "ectx:label", None] for end context marker
-    self.emit = []
+    # emitted events will be collected here, as parallel sequences (see
+    # addEmit) instead of a list of tuples
+    self.emitTS = array.array('d')
+    self.emitLabel = []
+    self.emitDuration = []
+    self.emitKind = array.array('B')
 
     # convert the spec into format that allows relatively painless lookup
     for label, enterCode, returnCode, contextName in spec:
-      if returnCode == None:
-        self.codeMap[enterCode] = (self.ACTION_MARK, label, None)
+      if returnCode is None:
+        self.setCode(enterCode, (self.ACTION_MARK, label, None))
       else:
-        self.codeMap[returnCode] = (self.ACTION_RETURN, label, contextName)
-        self.codeMap[enterCode] = (self.ACTION_ENTER, label, contextName)
+        self.setCode(returnCode, (self.ACTION_RETURN, label, contextName))
+        self.setCode(enterCode, (self.ACTION_ENTER, label, contextName))
+
+  # store the action for given code
+  def setCode(self, code, action):
+    if 0 <= code < self.CODE_TABLE_SIZE:
+      self.codeTable[code] = action
+    else:
+      self.codeMap[code] = action
 
   # returns False if code cannot be recognized.
   # does not check for time going backward (up to caller)
   def addEvent(self, ts, code):
-    if code not in self.codeMap:
+    if 0 <= code < self.CODE_TABLE_SIZE:
+      action = self.codeTable[code]
+    else:
+      action = self.codeMap.get(code)
+    if action is None:
       return False
-    self.actions.append((ts, self.codeMap[code]))
+    self.actions.append((ts, action))
     return True
 
   # convenience function that returns string suitable for indentation based on
@@ -212,17 +242,33 @@ class NestedBuilder:
   def getStackIndent(self):
     return " " * len(self.stack)
 
-  # unwind and emit top of the stack. ts is the emit point timestamp
-  # context is also the context of the event, currently unused
-  # returns the duration of removed entry
-  def unwindOne(self, ts):
-
-    assert(len(self.stack) > 0)
-
-    startedAt = self.stack[-1][0]
-    duration = ts - startedAt      
-    self.emit.append((startedAt, self.stack[-1][1], duration))
-    del self.stack[-1]
+  # collect one emitted event:
+  # startTS, label, duration|None, KIND_PLAIN (None for marks)
+  # startTS, context, None, KIND_CONTEXT_START for start context marker
+  # startTS, context, None, KIND_CONTEXT_END for end context marker
+  def addEmit(self, ts, label, duration, kind=KIND_PLAIN):
+    self.emitTS.append(ts)
+    self.emitLabel.append(label)
+    self.emitDuration.append(duration)
+    self.emitKind.append(kind)
+
+  # unwind and emit the stack entries at and above given depth (top first).
+  # ts is the emit point timestamp. context tracking is updated once for the
+  # net change, so no context markers are emitted for the entries in between
+  # returns list of (label, duration) of removed entries (top first)
+  def unwindTo(self, ts, depth):
+
+    assert(0 <= depth <= len(self.stack))
+
+    removed = []
+    if depth == len(self.stack):
+      return removed
+
+    for startedAt, label, context in reversed(self.stack[depth:]):
+      duration = ts - startedAt
+      self.addEmit(startedAt, label, duration)
+      removed.append((label, duration))
+    del self.stack[depth:]
 
     # update context tracking
     newContext = None
@@ -230,7 +276,7 @@ class NestedBuilder:
       newContext = self.stack[-1][-1]
     self.trackContext(ts, newContext)
 
-    return duration
+    return removed
 
   # handles emitting of context changing operations
   def trackContext(self, ts, newContext):
@@ -238,13 +284,13 @@ class NestedBuilder:
     if newContext == self.currentContext:
       return
 
-    if self.currentContext != None:
+    if self.currentContext is not None:
       # emit end of context first using current
-      self.emit.append((ts, "ectx:%s" % self.currentContext, None))
+      self.addEmit(ts, self.currentContext, None, self.KIND_CONTEXT_END)
     self.currentContext = newContext
-    if self.currentContext != None:
+    if self.currentContext is not None:
       # emit start of context next
-      self.emit.append((ts, "sctx:%s" % self.currentContext, None))
+      self.addEmit(ts, self.currentContext, None, self.KIND_CONTEXT_START)
 
   # this does the heavy lifting in resolving the actions
   def resolveActions(self):
@@ -263,174 +309,114 @@ class NestedBuilder:
         # push to stack
         #print("%s %s (startAt=%.9f)" % (self.getStackIndent(), label, ts))
         # if this event does not carry context, propagate the current one
-        if context == None:
+        if context is None:
           context = self.currentContext
         self.trackContext(ts, context)
         self.stack.append((ts, label, context))
       elif action == self.ACTION_MARK:
         #print("%s MARK(%s) (at=%.9f)" % (self.getStackIndent(), label, ts))
-        self.emit.append((ts, label, None))
+        self.addEmit(ts, label, None)
       else:
-        # leave
-        while len(self.stack) > 0 and self.stack[-1][1] != label:
-          unwindLabel = self.stack[-1][1]
-          dur = self.unwindOne(ts)
+        # leave. locate the matching entry from the top of the stack, anything
+        # above it is unwound implicitly in the same go
+        depth = len(self.stack) - 1
+        while depth >= 0 and self.stack[depth][1] != label:
+          depth -= 1
+        removed = self.unwindTo(ts, max(depth, 0))
+        if depth >= 0:
+          # last one removed is the matching entry
+          removed = removed[:-1]
+        for unwindLabel, dur in removed:
           print("WARNING: unwinding %s implicitly (duration %.9f s)" % (
-            unwindLabel, self.getStackIndent(), duration), file=sys.stderr)
-        if len(self.stack) == 0:
+            unwindLabel, dur), file=sys.stderr)
+        if depth < 0:
           print("WARNING: unwound all stack without finding start of %s" % label,
                 file=sys.stderr)
-        else:
-          dur = self.unwindOne(ts)
-          # print("%s <- dur=%.9f" % (self.getStackIndent(), dur))
 
     # unwind remaining entries
     # use the last timestamp of events as the ending point
-    # use unwindUntilLabel(ts, None), so it will never match)
-    #  which will use unwindOne(ts)
     ts = self.actions[-1][0]
-    while len(self.stack) > 0:
-      unwindLabel = self.stack[-1][1]
-      dur = self.unwindOne(ts)
+    for unwindLabel, dur in self.unwindTo(ts, 0):
       print("WARNING: Unwinding %s implicitly at end of trace" % unwindLabel,
             file=sys.stderr)
 
-    # custom comparison for emit entries to get correct ordering when the
-    # context start/end emit entries are present (a linear transform using
-    # regular key= escapes me, better approach appreciated)
-    def priorityCmp(a, b):
-      # rules:
-      #  1) ts always wins
-      tsa, tsb = a[0], b[0]
-      # cannot use cmp, since python3 doesn't have it
-      # ( https://docs.python.org/3.0/whatsnew/3.0.html )
-      cr = ((tsa>tsb)-(tsa<tsb))
-      if cr != 0:
-        return cr
-
-      # either side or both are context instructions (rules and precedence)
-      #  2) context-end is before context-start (ie, context switch)
-      #  3) context-end is after anything else at the same time (can this be
-      #     solved together with 1 though?)
-      #  4) context-start is before anything else at the same time
-      #
-      # we can express this as the following table:
-      #     a     |      b      ||   result
-      #  non-ctx  |    non-ctx  ||   cmp(la,lb)
-      #  non-ctx  |      c-end  ||     -1 (select a)
-      #  non-ctx  |    c-start  ||      1 (select b)
-      #    c-end  |    non-ctx  ||      1 (select b)
-      #    c-end  |      c-end  ||   cmp(la, lb) (combination shouldn't happen)
-      #    c-end  |    c-start  ||     -1 (select a)
-      #  c-start  |    non-ctx  ||     -1 (select a)
-      #  c-start  |      c-end  ||      1 (select b)
-      #  c-start  |    c-start  ||   cmp(la, lb) (combination shouldn't happen)
-      # Internally we'll encode zero as a signal to do a comparison based on
-      # labels (which will deal with the colon when required)
-      # Use s.split(":", 1)[-1] (picks the right side in both cases)
-      akey = None
-      if ':' in a[1]:
-        akey = a[1].split(':', 1)[0]
-      bkey = None
-      if ':' in b[1]:
-        bkey = b[1].split(':', 1)[0]
-      skey = (akey,bkey)
-      #print(skey)
-      # map of the rules k=(akey, bkey)
-      srules = {
-        (  None,   None):  0,
-        (  None, "ectx"): -1,
-        (  None, "sctx"):  1,
-        ("ectx",   None):  1,
-        ("ectx", "ectx"):  0,
-        ("ectx", "sctx"): -1,
-        ("sctx",   None): -1,
-        ("sctx", "ectx"):  1,
-        ("sctx", "sctx"):  0
-      }
-      cr = srules[skey]
-      # 0 here means that both sides were plain, or that both sides were
-      # the same context type. In both cases, we should just return the result
-      # of comparison using the original keys, otherwise return the value from
-      # the table as is
-      if cr == 0:
-        # was a plain-vs-plain comparison
-        return ((a[1]>b[1])-(a[1]<b[1]))
-      return cr
-
-    # this is copied verbatim from https://docs.python.org/3/howto/sorting.html#sortinghowto
-    # urgh. makes an python2 cmp-like wrapper for key-based sorter
-    def cmp_to_key(mycmp):
-      class K:
-        def __init__(self, obj, *args):
-          self.obj = obj
-        def __lt__(self, other):
-          return mycmp(self.obj, other.obj) < 0
-        def __gt__(self, other):
-          return mycmp(self.obj, other.obj) > 0
-        def __eq__(self, other):
-          return mycmp(self.obj, other.obj) == 0
-        def __le__(self, other):
-          return mycmp(self.obj, other.obj) <= 0
-        def __ge__(self, other):
-          return mycmp(self.obj, other.obj) >= 0
-        def __ne__(self, other):
-          return mycmp(self.obj, other.obj) != 0
-      return K
-
     # sort the event into proper order, taking into account the context
-    # switching markers
-    self.emit.sort(key=cmp_to_key(priorityCmp))
+    # switching markers: ts always wins, then the kind (see KIND_*) and
+    # otherwise labels are compared. the entries are zipped into plain tuples
+    # (ending with the index, which keeps equal entries in emit order) and
+    # sorted with tuple comparison, without a key function. the sequences are
+    # then rebuilt once from the sorted tuples
+    order = sorted(zip(self.emitTS, self.emitKind, self.emitLabel,
+                       range(len(self.emitTS))))
+    self.emitTS = array.array('d', [e[0] for e in order])
+    self.emitKind = array.array('B', [e[1] for e in order])
+    self.emitLabel = [e[2] for e in order]
+    self.emitDuration = [self.emitDuration[e[3]] for e in order]
 
   def emitTraceJSON(self, output):
     # right, form the data into json for consumption
-    # three kinds of events are emitted
-    print("[", end='', file=output)
-    for idx in range(len(self.emit)):
-      ts, label, dur = self.emit[idx]
+    # three kinds of events are emitted. records are formatted into a list and
+    # written out joined (one record per line), without per-record writes
+    records = []
+    for ts, label, dur, kind in zip(self.emitTS, self.emitLabel,
+                                    self.emitDuration, self.emitKind):
       # print(ts,label,dur)
       # Durations are in usecs for the trace viewer
-      ts = "%.3f" % (ts * 1000000)
-      if dur != None:
+      ts *= 1000000
+      if dur is not None:
         # event with duration (ph=X)
-        dur = "%.3f" % (dur * 1000000)
-        print('{"name":"%s","ts":%s,"dur":%s,"pid":0,"tid":0,"ph":"X","cat":"func","args":{}}' % (
-          label, ts, dur), end='', file=output)
+        records.append('{"name":"%s","ts":%.3f,"dur":%.3f,"pid":0,"tid":0,"ph":"X","cat":"func","args":{}}' % (
+          label, ts, dur * 1000000))
       else:
-        if ':' in label:
+        if kind != self.KIND_PLAIN:
           # context switch mark (ph=b|e)
-          name = label.split(":", 1)[-1]
           ph = "b"
-          if label.startswith('ectx:'):
+          if kind == self.KIND_CONTEXT_END:
             ph = "e"
-          print('{"name":"%s","cat":"context","ts":%s,"pid":0,"ph":"%s","id":"0x0"}' % (
-            name, ts, ph), end='', file=output)
+          records.append('{"name":"%s","cat":"context","ts":%.3f,"pid":0,"ph":"%s","id":"0x0"}' % (
+            label, ts, ph))
         else:
           # regular mark (ph=i). use process wide mark to make it more visible
-          print('{"name":"%s","ts":%s,"pid":0,"ph":"i","s":"p"}' % (
-            label, ts), end='', file=output)
-      if len(self.emit) > 1 and idx < len(self.emit)-1:
-        print(",", file=output)
-    print("]", file=output)
+          records.append('{"name":"%s","ts":%.3f,"pid":0,"ph":"i","s":"p"}' % (
+            label, ts))
+    output.write("[")
+    output.write(",\n".join(records))
+    output.write("]\n")
 
 if __name__ == '__main__':
 
   import argparse
 
   description = "Convert CSV formatted event list into trace data for Chrome"
+  # captures can be large, so use a large buffer for the data files (instead of
+  # the default of a few KiB) to cut down on read/write calls
+  bufferSize = 1 << 20
+
+  # open the event input with a large buffer. '-' is stdin, which is reopened
+  # so that the buffer applies also when piping from decode-serial
+  def openCSVInput(path):
+    try:
+      if path == '-':
+        return open(sys.stdin.fileno(), 'r', buffering=bufferSize,
+                    closefd=False)
+      return open(path, 'r', buffering=bufferSize)
+    except OSError as exc:
+      raise argparse.ArgumentTypeError("can't open '%s': %s" % (path, exc))
+
   optParser = argparse.ArgumentParser(description=description)
   optParser.add_argument('specfile', type=argparse.FileType('r'),
                          help="File to use as the specification for decoding")
-  optParser.add_argument('csvfile', nargs='?', type=argparse.FileType('r'),
-                         default=sys.stdin,
+  optParser.add_argument('csvfile', nargs='?', type=openCSVInput,
+                         default='-',
                          help="File to read events from (if not stdin)")
-  optParser.add_argument('outfile', nargs='?', type=argparse.FileType('w'),
+  optParser.add_argument('outfile', nargs='?',
+                         type=argparse.FileType('w', bufferSize),
                          default=sys.stdout,
                          help="File to write to (if not stdout)")
   args = optParser.parse_args()
 
   spec = parseSpec(args.specfile)
-  if spec == None:
+  if spec is None:
     print("ERROR: There was one or more syntax error in the specification", file=sys.stderr)
     sys.exit(1)
   if not isSpecSemanticallyValid(spec):
@@ -453,14 +439,14 @@ if __name__ == '__main__':
       continue
     comps = line.split(",")[:2]
     ts, code = float(comps[0]), int(comps[1])
-    if prevTS != None:
+    if prevTS is not None:
       if prevTS > ts:
-        print("ERROR(%s:%u): Timestamp goes backwards" % (csvInput.name, lineNumber), file=sys.stderr)
+        print("ERROR(%s:%u): Timestamp goes backwards" % (args.csvfile.name, lineNumber), file=sys.stderr)
         sys.exit(1)
     prevTS = ts
     #print(ts, code)
     if not builder.addEvent(ts, code):
-      print("ERROR(%s:%u): code %u is unknown" % (csvInput.name, lineNumber, code), file=sys.stderr)
+      print("ERROR(%s:%u): code %u is unknown" % (args.csvfile.name, lineNumber, code), file=sys.stderr)
       sys.exit(1)
 
     lineNumber += 1